@@ -9,6 +9,16 @@ Nov 2016
 import uuid
 import github
 import json
+import copy
+import math
+import signal
+import gzip
+import shutil
+import sqlite3
+import datetime
+import calendar
+import collections
+import re
 import socket
 import os
 from tempfile import mkstemp, mkdtemp
@@ -24,7 +34,7 @@ import glob
 from distutils.spawn import find_executable
 
 # non standards, in requirements.txt
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 import requests
 import github
 
@@ -139,6 +149,309 @@ def set_commit_status(args):
     resp = requests.post(url=args['statuses_url'], data=data, headers=headers)
     assert resp.status_code == 201, (resp.status_code, resp.text)
 
+
+def parse_since(since):
+    """ parses a unix timestamp or a UTC date (2016-11-01, 2016-11-01T10:00:00 or 2016-11-01 10:00:00), None if invalid """
+    try:
+        return float(since)
+    except ValueError:
+        pass
+    for date_format in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']:
+        try:
+            return calendar.timegm(datetime.datetime.strptime(since, date_format).timetuple())
+        except ValueError:
+            pass
+    return None
+
+
+def tokenize(text):
+    """ splits text into lowercase tokens, like the default tokenizer of SQLite FTS5 """
+    return re.findall(r'[^\W_]+', text.lower())
+
+
+def parse_cpulist(cpulist):
+    """ parses a Linux cpu list such as "0-3,8,10-11" into a list of cpu ids """
+    result = []
+    for chunk in cpulist.strip().split(','):
+        if chunk == "": continue
+        if '-' in chunk:
+            start, end = chunk.split('-')
+            result.extend(range(int(start), int(end) + 1))
+        else:
+            result.append(int(chunk))
+    return result
+
+
+def get_numa_nodes(sys_path='/sys/devices/system/node'):
+    """ returns the cpus of each NUMA node as a list of lists, one single node if /sys does not expose them """
+    usable = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else set(range(os.cpu_count() or 1))
+    nodes = []
+    for path in sorted(glob.glob(os.path.join(sys_path, 'node[0-9]*', 'cpulist'))):
+        with open(path) as f:
+            cpus = [x for x in parse_cpulist(f.read()) if x in usable]
+        if len(cpus) > 0: nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes = [sorted(usable)]
+    return nodes
+
+
+class CPUSetAllocator:
+    """ gives each running job a disjoint set of cpus, taken from a single NUMA node whenever possible
+    nodes: list of lists of cpu ids, see get_numa_nodes
+    """
+
+    def __init__(self, cores_per_job, nodes=None):
+        if cores_per_job < 1: raise ValueError("cores_per_job must be at least 1, got " + str(cores_per_job))
+        self.nodes = nodes if nodes != None else get_numa_nodes()
+        self.cores_per_job = min(cores_per_job, sum(len(x) for x in self.nodes))
+        self.free = [list(x) for x in self.nodes]
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ blocks until enough cpus are free, returns the list of allocated cpus """
+        with self.condition:
+            while sum(len(x) for x in self.free) < self.cores_per_job:
+                self.condition.wait()
+            # first choice: the node with the fewest free cpus that can host the whole job
+            fitting = [x for x in self.free if len(x) >= self.cores_per_job]
+            if len(fitting) > 0:
+                node = min(fitting, key=len)
+                cpus = node[:self.cores_per_job]
+                del node[:self.cores_per_job]
+                return cpus
+            # otherwise we span several nodes, starting with the least loaded ones
+            cpus = []
+            for node in sorted(self.free, key=len, reverse=True):
+                taken = node[:self.cores_per_job - len(cpus)]
+                del node[:len(taken)]
+                cpus += taken
+                if len(cpus) == self.cores_per_job: break
+            return cpus
+
+    def release(self, cpus):
+        with self.condition:
+            for i, node in enumerate(self.nodes):
+                self.free[i] += [x for x in cpus if x in node]
+                self.free[i].sort()
+            self.condition.notify_all()
+
+
+class DurationHistory:
+    """ records the durations of the jobs per hook and per repo, and derives the job timeouts from them
+    the timeout is p99 * factor, bounded by floor and ceiling, and ceiling as long as there is not enough history
+    path: optional JSON file so that the history survives restarts
+    """
+
+    def __init__(self, path=None, factor=3, floor=60, ceiling=60*60, min_samples=5, max_samples=200):
+        self.path = path
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.durations = {}
+        if self.path != None and os.path.isfile(self.path):
+            try:
+                with open(self.path) as f: self.durations = json.load(f)
+            except ValueError:
+                print('!!!!!!!!  cannot read the job durations in '+self.path+', starting with an empty history')
+
+    def key(self, hook, repo):
+        return str(repo) + " " + str(hook)
+
+    def record(self, hook, repo, duration):
+        with self.lock:
+            durations = self.durations.setdefault(self.key(hook, repo), [])
+            durations.append(duration)
+            del durations[:-self.max_samples]
+            if self.path != None:
+                # written aside then renamed, a crash must not leave a truncated file
+                with open(self.path + ".tmp", 'w') as f: json.dump(self.durations, f)
+                os.replace(self.path + ".tmp", self.path)
+
+    def percentile(self, hook, repo, p):
+        """ nearest-rank percentile of the recorded durations, None if there are not enough of them """
+        with self.lock:
+            durations = sorted(self.durations.get(self.key(hook, repo), []))
+        if len(durations) < self.min_samples: return None
+        return durations[max(0, math.ceil(p / 100 * len(durations)) - 1)]
+
+    def get_timeout(self, hook, repo):
+        p99 = self.percentile(hook, repo, 99)
+        if p99 == None: return self.ceiling
+        return min(self.ceiling, max(self.floor, p99 * self.factor))
+
+
+class TraceStore:
+    """ stores the traces of the jobs gzip-compressed in a dedicated directory, which is kept across restarts
+    the oldest traces are removed when the store, plus the optional TraceIndex in self.index, exceeds max_bytes
+    """
+
+    def __init__(self, path, max_bytes=1024*1024*1024, compresslevel=6):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.lock = threading.Lock()
+        # the index of the traces, which forgets the removed traces and whose size counts in max_bytes
+        self.index = None
+        # trace id -> size of the gzip file, oldest first, so that retention does not list the directory
+        self.sizes = collections.OrderedDict()
+        files = [os.path.join(self.path, x) for x in os.listdir(self.path) if x.endswith(".txt.gz")]
+        for x in sorted(files, key=os.path.getmtime):
+            self.sizes[os.path.basename(x)[:-len(".txt.gz")]] = os.path.getsize(x)
+        self.total = sum(self.sizes.values())
+
+    def get_path(self, trace_id):
+        return os.path.join(self.path, os.path.basename(trace_id) + ".txt.gz")
+
+    def has(self, trace_id):
+        return os.path.isfile(self.get_path(trace_id))
+
+    def ingest(self, trace_id, trace_path):
+        """ compresses the trace file into the store and removes the original, returns the ids of the traces removed by retention """
+        if not os.path.isfile(trace_path): return []
+        tmp = self.get_path(trace_id) + ".tmp"
+        with open(trace_path, 'rb') as f_in, gzip.open(tmp, 'wb', compresslevel=self.compresslevel) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        with self.lock:
+            os.replace(tmp, self.get_path(trace_id))
+            self.total += os.path.getsize(self.get_path(trace_id)) - self.sizes.pop(trace_id, 0)
+            self.sizes[trace_id] = os.path.getsize(self.get_path(trace_id))
+        os.remove(trace_path)
+        return self.apply_retention()
+
+    def apply_retention(self):
+        """ removes the oldest traces until the store fits in max_bytes, returns the ids of the removed traces """
+        removed = []
+        with self.lock:
+            while len(self.sizes) > 0 and self.total + (self.index.size() if self.index != None else 0) > self.max_bytes:
+                trace_id, size = self.sizes.popitem(last=False)
+                self.total -= size
+                # the index needs the trace to forget it
+                if self.index != None: self.index.remove([trace_id])
+                try:
+                    os.remove(self.get_path(trace_id))
+                except FileNotFoundError:
+                    pass
+                removed.append(trace_id)
+        return removed
+
+    def open(self, trace_id):
+        """ returns the gzip file of the trace opened in binary mode, None if it is not in the store
+        the open file can still be read if retention removes the trace in the meantime
+        """
+        try:
+            return open(self.get_path(trace_id), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def read_chunks(self, f, decompress=False, chunk_size=64*1024):
+        """ generator over the gzip bytes of a file given by open(), or over the decompressed bytes if decompress is set
+        the file is closed at the end
+        """
+        with f:
+            source = gzip.GzipFile(fileobj=f) if decompress else f
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                yield chunk
+
+
+class TraceIndex:
+    """ full-text index over the traces (SQLite FTS5, raises sqlite3.OperationalError if not available), fed as jobs finish
+    trace_docs has one row per trace, is contentless and has no token positions (detail=none): it only selects
+    the traces containing all the tokens of the words, the matching lines of these traces are then read from
+    the compressed traces of the store
+    path: the SQLite database file
+    traces: the TraceStore of the traces
+    """
+
+    def __init__(self, path, traces):
+        self.path = path
+        self.traces = traces
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT UNIQUE, repo TEXT, task TEXT, finished REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_repo ON jobs (repo, finished)')
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS trace_docs USING fts5(text, content='', detail=none)")
+        self.db.commit()
+
+    def add(self, job_id, job, trace_path):
+        """ indexes the trace of a finished job, job is the meta information from GakoCI.jobs """
+        if not os.path.isfile(trace_path): return
+        with open(trace_path, encoding='utf-8', errors='replace') as f: text = f.read()
+        self.remove([job_id])
+        with self.lock, self.db:
+            cursor = self.db.execute('INSERT INTO jobs (job_id, repo, task, finished) VALUES (?, ?, ?, ?)', (job_id, job['repo'], job['task'], job['finished']))
+            self.db.execute('INSERT INTO trace_docs (rowid, text) VALUES (?, ?)', (cursor.lastrowid, text))
+
+    def remove(self, job_ids):
+        """ forgets the traces removed from the trace store, to be called before the compressed traces are deleted """
+        with self.lock, self.db:
+            deleted = False
+            for job_id in job_ids:
+                row = self.db.execute('SELECT id FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+                if row == None: continue
+                self.db.execute('DELETE FROM jobs WHERE id = ?', (row[0],))
+                # a contentless table needs the original text to delete a row, it is read from the compressed trace
+                # without it, the row stays in trace_docs, but it is never returned since ids are not reused (AUTOINCREMENT)
+                f = self.traces.open(job_id)
+                if f == None: continue
+                with f, gzip.open(f, 'rt', encoding='utf-8', errors='replace') as trace: text = trace.read()
+                self.db.execute("INSERT INTO trace_docs (trace_docs, rowid, text) VALUES ('delete', ?, ?)", (row[0], text))
+                deleted = True
+            if deleted:
+                # deleted rows only free disk space once the FTS5 segments are merged, a bounded amount of work
+                self.db.execute("INSERT INTO trace_docs (trace_docs, rank) VALUES ('merge', -500)")
+
+    def size(self):
+        """ the number of bytes used by the index, the free pages of the database are not counted """
+        with self.lock:
+            page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+            page_count = self.db.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = self.db.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def read_lines(self, job_id, words, max_lines):
+        """ the lines of the compressed trace containing all the tokens of any of the words """
+        tokenized = [tokenize(x) for x in words]
+        result = []
+        f = self.traces.open(job_id)
+        if f == None: return result
+        with f, gzip.open(f, 'rt', encoding='utf-8', errors='replace') as trace:
+            for i, line in enumerate(trace, 1):
+                tokens = set(tokenize(line))
+                if any(all(t in tokens for t in word) for word in tokenized):
+                    result.append({'line_number': i, 'text': line.rstrip('\n')})
+                    if len(result) == max_lines: break
+        return result
+
+    def search(self, query, repo=None, since=None, max_jobs=50, max_lines_per_job=5):
+        """ returns the most recent jobs whose trace contains all the words of query, with the lines containing any of them """
+        # words without token characters would match nothing
+        words = [x for x in query.split() if len(tokenize(x)) > 0]
+        if len(words) == 0: return []
+        # no positions in the index, so eg "Foo.java:12" matches the traces containing the tokens foo, java and 12
+        tokens = [t for x in words for t in tokenize(x)]
+        sql = ('SELECT jobs.job_id, jobs.repo, jobs.task, jobs.finished '
+               'FROM trace_docs JOIN jobs ON jobs.id = trace_docs.rowid WHERE trace_docs MATCH ?')
+        args = [" AND ".join('"' + t + '"' for t in tokens)]
+        if repo != None:
+            sql += ' AND jobs.repo = ?'
+            args.append(repo)
+        if since != None:
+            sql += ' AND jobs.finished >= ?'
+            args.append(since)
+        # jobs are inserted as they finish, so the most recent ones have the highest rowids
+        sql += ' ORDER BY trace_docs.rowid DESC LIMIT ?'
+        args.append(max_jobs)
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [{'job_id': job_id, 'repo': job_repo, 'task': task, 'finished': finished,
+                 'lines': self.read_lines(job_id, words, max_lines_per_job)} for job_id, job_repo, task, finished in rows]
+
+
 class GakoCITask:
     """ A CI task to be executed 
     event_action : EventAction
@@ -157,6 +470,10 @@ class ScriptCITask(GakoCITask):
     def __init__(self, script_path):
         assert os.path.isfile(script_path)
         self.script_path = script_path
+        self.cpuset = None
+        self.timeout = None
+        self.timed_out = False
+        self.duration = None
     
     def name(self):
         return os.path.basename(self.script_path)
@@ -180,7 +497,37 @@ class ScriptCITask(GakoCITask):
         # default value
         self.status = "exec in " + event_action.cwd
         self.returncode = 0
-        
+
+        self.timeout = server.get_job_timeout(self.name(), event_action.meta_info['build_owner'] + "/" + event_action.meta_info['build_repo'])
+
+        # each running job gets its own cpus, so that concurrent jobs do not fight over the same cores
+        self.cpuset = server.cpu_allocator.acquire() if server.cpu_allocator != None else None
+        # visible in the job meta information while the job runs
+        if hasattr(event_action, 'job_id'): server.update_job(event_action.job_id, {'cpuset': self.cpuset})
+        # on Linux, the affinity of pid 0 is the one of the current thread only, and the script inherits it at fork,
+        # so the script and all its children are pinned from the start (preexec_fn is not safe with concurrent threads)
+        thread_affinity = os.sched_getaffinity(0) if self.cpuset != None else None
+        try:
+            if self.cpuset != None: os.sched_setaffinity(0, self.cpuset)
+            # the duration of the script itself, without the time spent waiting for cpus
+            start = time.time()
+            self.run_script(event_action, server)
+            self.duration = time.time() - start
+        finally:
+            if self.cpuset != None:
+                os.sched_setaffinity(0, thread_affinity)
+                server.cpu_allocator.release(self.cpuset)
+        return
+
+    def kill_process_group(self, proc):
+        """ kills the script and all its children, otherwise orphans keep the pipes open and communicate() blocks """
+        self.timed_out = True
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def run_script(self, event_action, server):
         if not self.script_path.endswith(".sh"):
             command = [self.script_path] + event_action.arguments()
             print(" ".join(command))
@@ -191,10 +538,12 @@ class ScriptCITask(GakoCITask):
                 cwd=event_action.cwd,
                 stdin=PIPE,
                 stdout=PIPE, stderr=DEVNULL,
-                universal_newlines=True
+                universal_newlines=True,
+                start_new_session=True # the script is the leader of its own process group
             )
             # by convention the status is the last line
-            timer = threading.Timer(server.get_script_timeout_in_seconds(), proc.kill)
+            timer = threading.Timer(self.timeout, self.kill_process_group, args=(proc,))
+            timer.start()
             out = proc.communicate()[0].split("\n")
             timer.cancel()
             self.status = out[-1] if len(out[-1])>0 else (out[-2] if len(out)>=2 else "no output")
@@ -208,7 +557,8 @@ class ScriptCITask(GakoCITask):
                 cwd=event_action.cwd,
                 stdin=PIPE,
                 stdout=PIPE, stderr=DEVNULL,
-                universal_newlines=True
+                universal_newlines=True,
+                start_new_session=True # the script is the leader of its own process group
             )
             stdin = ""
             for i,val in event_action.meta_info.items():
@@ -226,7 +576,8 @@ class ScriptCITask(GakoCITask):
             stdin = stdin + "\nrm -rf .git\n"
 
             #print(stdin)
-            timer = threading.Timer(server.get_script_timeout_in_seconds(), proc.kill)
+            timer = threading.Timer(self.timeout, self.kill_process_group, args=(proc,))
+            timer.start()
             out = proc.communicate(stdin)[0].split("\n")
             timer.cancel()
             # by convention the status is the last line
@@ -260,9 +611,18 @@ class GakoCI:
     """ 
     The main class of the GakoCI server.
     Usage: GakoCI(github_token="khkjhkjf", repos = ["monperrus/test-repo"]).run()
+    max_parallel_jobs: number of jobs that run at the same time
+    cores_per_job: if set, each running job is pinned to its own set of cores_per_job cpus
+    durations_path: if set, the job durations used to compute the timeouts are stored in this JSON file
+    timeout_factor, timeout_floor, timeout_ceiling: the job timeout is p99 of the past durations * timeout_factor, bounded by timeout_floor and timeout_ceiling (in seconds)
+    traces_dir: where the compressed traces are stored, kept across restarts (gakoci-traces next to hooks_dir by default)
+    max_traces_bytes: the oldest traces are removed when the traces take more disk space than this
+    trace_index_path: the SQLite database of the full-text index over the traces (in traces_dir by default)
     """
 
-    def __init__(self, repos, github_token="", host="127.0.0.1", port=5000, hooks_dir='./hooks'):
+    def __init__(self, repos, github_token="", host="127.0.0.1", port=5000, hooks_dir='./hooks', max_parallel_jobs=1, cores_per_job=None, durations_path=None, timeout_factor=3, timeout_floor=60, timeout_ceiling=60*60, traces_dir=None, max_traces_bytes=1024*1024*1024, trace_index_path=None):
+        if max_parallel_jobs < 1: raise ValueError("max_parallel_jobs must be at least 1, got " + str(max_parallel_jobs))
+        if cores_per_job != None and not hasattr(os, 'sched_setaffinity'): raise ValueError("cores_per_job requires os.sched_setaffinity, which is not available on this platform")
         self.github_token = github_token
         self.repos = repos
         self.host = host
@@ -272,11 +632,22 @@ class GakoCI:
         self.set_public_url()
         self.register_webhooks()
         self.ran = {}
+        # job id -> meta information about the job (task, repo, cpuset, duration, ...)
+        self.jobs = {}
         self.tasks = []
 
-        # used so that only one task is performed at a time
+        # used so that only max_parallel_jobs tasks are performed at a time
         # otherwise with multiple builds, all are done in parallel and the server goes into out-of-memory
-        self.lock = threading.Lock()
+        self.lock = threading.BoundedSemaphore(max_parallel_jobs)
+        self.cpu_allocator = CPUSetAllocator(cores_per_job) if cores_per_job != None else None
+        self.durations = DurationHistory(durations_path, factor=timeout_factor, floor=timeout_floor, ceiling=timeout_ceiling)
+        self.traces = TraceStore(traces_dir if traces_dir != None else os.path.join(os.path.dirname(os.path.abspath(hooks_dir)), "gakoci-traces"), max_bytes=max_traces_bytes)
+        try:
+            self.trace_index = TraceIndex(trace_index_path if trace_index_path != None else os.path.join(self.traces.path, "index.sqlite"), self.traces)
+        except sqlite3.OperationalError as e:
+            print('!!!!!!!!  cannot create the trace index (SQLite without FTS5?), /traces/search is disabled: '+str(e))
+            self.trace_index = None
+        self.traces.index = self.trace_index
         pass  # end __init__
 
     def shutdown(self):
@@ -351,6 +722,18 @@ class GakoCI:
         """ can be overridden by subclasses TODO: move ??"""
         return 60*10 # 10 minutes
 
+    def get_job_timeout(self, hook, repo):
+        """ derived from the past durations of the hook on this repo, can be overridden by subclasses
+        a subclass overriding get_script_timeout_in_seconds keeps its fixed timeout
+        """
+        if getattr(self.get_script_timeout_in_seconds, '__func__', None) is not GakoCI.get_script_timeout_in_seconds:
+            return self.get_script_timeout_in_seconds()
+        return self.durations.get_timeout(hook, repo)
+
+    def update_job(self, job_id, values):
+        """ replaces the meta information of the job in a single assignment, so that /jobs/<job_id> never serializes a dict being modified """
+        self.jobs[job_id] = dict(self.jobs[job_id], **values)
+
     def execute_task(self, task, event_action):
         """ execute the task in a specific directory """
         
@@ -360,15 +743,48 @@ class GakoCI:
         try:
             self.lock.acquire(True)
             cwd = mkdtemp()
-            self.ran[os.path.basename(cwd)] = cwd            
+            job_id = os.path.basename(cwd)
+            self.ran[job_id] = cwd
             description = cwd
             
-            # where we work
+            # where we work, the event action is shared by all tasks of the event and jobs may run concurrently
+            event_action = copy.copy(event_action)
+            event_action.meta_info = dict(event_action.meta_info)
             event_action.cwd = cwd
-            
+            event_action.job_id = job_id
+
+            self.jobs[job_id] = {
+                'task': task.name(),
+                'event_type': event_action.meta_info['event_type'],
+                'repo': event_action.meta_info['build_owner'] + "/" + event_action.meta_info['build_repo'],
+                'commit': event_action.meta_info.get('commit', "unknown"),
+                'start': time.time(),
+                'cpuset': None
+            }
+
             # execute the task
             task.execute(event_action, self)
 
+            self.update_job(job_id, {
+                'returncode': getattr(task, 'returncode', None),
+                'duration': getattr(task, 'duration', None),
+                'timeout': getattr(task, 'timeout', None),
+                'timed_out': getattr(task, 'timed_out', False),
+                'finished': time.time()
+            })
+            job = self.jobs[job_id]
+
+            # a killed job says nothing about the time it actually needs
+            if job['duration'] != None and not job['timed_out']: self.durations.record(task.name(), job['repo'], job['duration'])
+
+            # the trace is indexed, then moves out of the workspace into the compressed trace store
+            # a failure of the index must not lose the result of the job
+            try:
+                if self.trace_index != None: self.trace_index.add(job_id, job, os.path.join(cwd, "trace.txt"))
+            except (sqlite3.Error, OSError) as e:
+                print('!!!!!!!!  cannot index the trace of '+job_id+': '+str(e))
+            self.traces.ingest(job_id, os.path.join(cwd, "trace.txt"))
+
             if task.status:
                 description = task.status
             
@@ -400,14 +816,42 @@ class GakoCI:
         @application.route('/traces/<trace_id>', methods=['GET'])
         def trace(trace_id):
             output = "no trace available"
-            if trace_id in self.ran:
-                path = self.ran[trace_id] + "/trace.txt"
-                if not os.path.isfile(path): 
+            # the store also has the traces of the previous runs of the server
+            f = self.traces.open(trace_id)
+            if f == None and trace_id in self.ran:
+                # the job is still running, the trace is still in the job directory
+                try:
+                    with open(self.ran[trace_id] + "/trace.txt") as o: output = o.read()
+                except FileNotFoundError:
+                    # either there is no trace, or the job has just finished and the trace is now in the store
+                    f = self.traces.open(trace_id)
                     output = "no trace for this CI job"
-                else:
-                    with open(path) as o: output = o.read()
+            if f != None and request.accept_encodings['gzip'] > 0:
+                # served as stored, the client decompresses
+                return Response(self.traces.read_chunks(f), 200, {'Content-Type': 'text/plain; charset=utf-8', 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+            if f != None:
+                return Response(self.traces.read_chunks(f, decompress=True), 200, {'Content-Type': 'text/plain; charset=utf-8', 'Vary': 'Accept-Encoding'})
             return output, 200, {'Content-Type': 'text/plain; charset=utf-8'}
 
+        @application.route('/traces/search', methods=['GET'])
+        def search_traces():
+            """ /traces/search?q=<words>&repo=<owner/repo>&since=<timestamp or UTC date> """
+            if self.trace_index == None: abort(501)
+            query = request.args.get('q', '')
+            if query.strip() == "": abort(400)
+            since = request.args.get('since')
+            if since != None:
+                since = parse_since(since)
+                if since == None: abort(400)
+            result = self.trace_index.search(query, repo=request.args.get('repo'), since=since)
+            for job in result: job['trace_url'] = self.public_url + '/traces/' + job['job_id']
+            return json.dumps(result), 200, {'Content-Type': 'application/json'}
+
+        @application.route('/jobs/<job_id>', methods=['GET'])
+        def job(job_id):
+            if job_id not in self.jobs: abort(404)
+            return json.dumps(self.jobs[job_id]), 200, {'Content-Type': 'application/json'}
+
         @application.route('/', methods=['GET'])
         def about():
             return "running <a href='http://github.com/monperrus/gakoci'>http://github.com/monperrus/gakoci</a>"
@@ -441,12 +885,16 @@ class GakoCI:
 class GakoCINgrok(GakoCI):
     """ A GakoCI that uses Ngrok, it requires environment variable NGROK_AUTH_TOKEN """
 
-    def __init__(self, repos, github_token, host="127.0.0.1", port=5000, hooks_dir='./hooks', auth_token=None):
+    def __init__(self, repos, github_token, host="127.0.0.1", port=5000, hooks_dir='./hooks', auth_token=None, max_parallel_jobs=1, cores_per_job=None, durations_path=None, timeout_factor=3, timeout_floor=60, timeout_ceiling=60*60, traces_dir=None, max_traces_bytes=1024*1024*1024, trace_index_path=None):
         if auth_token == None:
             auth_token = os.environ["NGROK_AUTH_TOKEN"]
         self.setUp_ngrok(port, auth_token=auth_token)
         super().__init__(repos=repos, github_token=github_token,
-                         host=host, port=port, hooks_dir=hooks_dir)
+                         host=host, port=port, hooks_dir=hooks_dir,
+                         max_parallel_jobs=max_parallel_jobs, cores_per_job=cores_per_job,
+                         durations_path=durations_path, timeout_factor=timeout_factor,
+                         timeout_floor=timeout_floor, timeout_ceiling=timeout_ceiling, traces_dir=traces_dir,
+                         max_traces_bytes=max_traces_bytes, trace_index_path=trace_index_path)
 
     def set_public_url(self):
         self.public_url = self.ngrokconfig["url"]
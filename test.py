@@ -21,6 +21,9 @@ import json
 import uuid
 import builtins
 import subprocess
+import tempfile
+import gzip
+import sqlite3
 import socket as so 
 def create_pull_request(args):
     """ 
@@ -80,6 +83,256 @@ class HelperTestCase(unittest.TestCase):
         self.assertEqual("930", gakoci.get_core_info_pull_request_file('test/resources/pull_request_event.json')['pr_number'])
 
 
+class CPUSetTestCase(unittest.TestCase):
+    """  python3 -m unittest test.CPUSetTestCase  """
+
+    def test_allocator(self):
+        self.assertEqual([0, 1, 2, 3, 8, 10, 11], gakoci.parse_cpulist("0-3,8,10-11\n"))
+
+        # two NUMA nodes of 4 cpus
+        allocator = gakoci.CPUSetAllocator(2, nodes=[[0, 1, 2, 3], [4, 5, 6, 7]])
+        a = allocator.acquire()
+        b = allocator.acquire()
+        c = allocator.acquire()
+        # disjoint cpu sets
+        self.assertEqual(6, len(set(a + b + c)))
+        # each job stays on a single node
+        for cpus in [a, b, c]:
+            self.assertTrue(set(cpus) <= {0, 1, 2, 3} or set(cpus) <= {4, 5, 6, 7})
+
+        # released cpus can be reused
+        allocator.release(a)
+        self.assertEqual(sorted(a), sorted(allocator.acquire()))
+
+        # a job bigger than a node spans several nodes
+        allocator = gakoci.CPUSetAllocator(6, nodes=[[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(6, len(set(allocator.acquire())))
+
+        # at least one cpu per job
+        self.assertRaises(ValueError, gakoci.CPUSetAllocator, 0, nodes=[[0, 1]])
+        self.assertRaises(ValueError, gakoci.GakoCI, repos=["monperrus/test"], max_parallel_jobs=0)
+
+    def test_pinning(self):
+        """ the children forked by the script are pinned, the affinity of the worker thread is restored """
+        if os.path.exists("testhooks"):
+            shutil.rmtree("testhooks")
+        os.system('mkdir -p testhooks')
+        os.system('printf "#!/bin/sh\nsh -c \\"grep Cpus_allowed_list /proc/self/status\\""  > testhooks/push-monperrus-test')
+        os.system('chmod 755 testhooks/*')
+        server = gakoci.GakoCI(repos=["monperrus/test"], hooks_dir="testhooks", cores_per_job=1, traces_dir=tempfile.mkdtemp())
+        cpu = sorted(os.sched_getaffinity(0))[-1]
+        server.cpu_allocator = gakoci.CPUSetAllocator(1, nodes=[[cpu]])
+        event_action = server.get_core_info_depending_on_event_type("push", 'test/resources/push_event.json')
+        event_action.cwd = "testhooks"
+        affinity = os.sched_getaffinity(0)
+        task = gakoci.ScriptCITask("testhooks/push-monperrus-test")
+        task.execute(event_action, server)
+        self.assertEqual("Cpus_allowed_list:\t" + str(cpu), task.status)
+        self.assertEqual(affinity, os.sched_getaffinity(0))
+
+
+class TimeoutTestCase(unittest.TestCase):
+    """  python3 -m unittest test.TimeoutTestCase  """
+
+    def test_history(self):
+        history = gakoci.DurationHistory(floor=10, ceiling=1000, factor=2, min_samples=3)
+        # no history yet
+        self.assertEqual(1000, history.get_timeout("push-foo-bar", "foo/bar"))
+        for d in [30, 20, 40]: history.record("push-foo-bar", "foo/bar", d)
+        self.assertEqual(80, history.get_timeout("push-foo-bar", "foo/bar"))
+        # per repo
+        self.assertEqual(1000, history.get_timeout("push-foo-bar", "foo/other"))
+        # floor and ceiling
+        for d in [1, 1, 1]: history.record("fast", "foo/bar", d)
+        self.assertEqual(10, history.get_timeout("fast", "foo/bar"))
+        for d in [900, 900, 900]: history.record("slow", "foo/bar", d)
+        self.assertEqual(1000, history.get_timeout("slow", "foo/bar"))
+
+    def test_persistence(self):
+        path = os.path.join(tempfile.mkdtemp(), "durations.json")
+        history = gakoci.DurationHistory(path, min_samples=1)
+        history.record("push-foo-bar", "foo/bar", 100)
+        self.assertEqual(300, gakoci.DurationHistory(path, min_samples=1).get_timeout("push-foo-bar", "foo/bar"))
+        # a truncated file does not prevent the server from starting
+        with open(path, "w") as f: f.write('{"foo/bar push-foo-bar": [10')
+        self.assertEqual({}, gakoci.DurationHistory(path).durations)
+
+    def test_overrides(self):
+        server = gakoci.GakoCI(repos=["monperrus/test"], timeout_factor=2, timeout_floor=5, timeout_ceiling=50, traces_dir=tempfile.mkdtemp())
+        self.assertEqual(50, server.get_job_timeout("push-foo-bar", "foo/bar"))
+        self.assertEqual((2, 5), (server.durations.factor, server.durations.floor))
+
+    def test_kill_process_group(self):
+        """ a child still holding stdout must not block the job after the timeout """
+        if os.path.exists("testhooks"):
+            shutil.rmtree("testhooks")
+        os.system('mkdir -p testhooks')
+        os.system('printf "#!/bin/sh\nsleep 60 &\nsleep 60"  > testhooks/push-monperrus-test')
+        os.system('chmod 755 testhooks/*')
+        # a subclass with the fixed timeout hook of the previous versions
+        class FixedTimeoutGakoCI(gakoci.GakoCI):
+            def get_script_timeout_in_seconds(self):
+                return 1
+        server = FixedTimeoutGakoCI(repos=["monperrus/test"], hooks_dir="testhooks", traces_dir=tempfile.mkdtemp())
+        event_action = server.get_core_info_depending_on_event_type("push", 'test/resources/push_event.json')
+        event_action.cwd = "testhooks"
+        task = gakoci.ScriptCITask("testhooks/push-monperrus-test")
+        start = time.time()
+        task.execute(event_action, server)
+        self.assertTrue(time.time() - start < 30)
+        self.assertTrue(task.timed_out)
+        self.assertEqual(1, task.timeout)
+        self.assertTrue(task.duration < 30)
+        self.assertNotEqual(0, task.returncode)
+
+
+class TraceTestCase(unittest.TestCase):
+    """  python3 -m unittest test.TraceTestCase  """
+
+    def test_serve(self):
+        server = gakoci.GakoCI(repos=["monperrus/test"], traces_dir=tempfile.mkdtemp())
+        cwd = tempfile.mkdtemp()
+        with open(os.path.join(cwd, "trace.txt"), "w") as f: f.write("foo\n" * 1000)
+        server.ran["job1"] = cwd
+        server.traces.ingest("job1", os.path.join(cwd, "trace.txt"))
+        self.assertFalse(os.path.exists(os.path.join(cwd, "trace.txt")))
+        self.assertTrue(os.path.getsize(server.traces.get_path("job1")) < 4000)
+
+        client = server.application.test_client()
+        # the compressed bytes as stored
+        response = client.get("/traces/job1", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual("foo\n" * 1000, gzip.decompress(response.data).decode("utf-8"))
+        # decompressed on the fly
+        response = client.get("/traces/job1")
+        self.assertFalse("Content-Encoding" in response.headers)
+        self.assertEqual("foo\n" * 1000, response.data.decode("utf-8"))
+
+        # gzip explicitly refused
+        response = client.get("/traces/job1", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertFalse("Content-Encoding" in response.headers)
+        self.assertEqual("foo\n" * 1000, response.data.decode("utf-8"))
+        # the trace remains readable if retention removes it while it is served
+        response = client.get("/traces/job1")
+        os.remove(server.traces.get_path("job1"))
+        self.assertEqual("foo\n" * 1000, response.data.decode("utf-8"))
+
+        # a running job, its trace is still in the job directory
+        server.ran["job2"] = cwd
+        with open(os.path.join(cwd, "trace.txt"), "w") as f: f.write("running\n")
+        self.assertEqual("running\n", client.get("/traces/job2").data.decode("utf-8"))
+        os.remove(os.path.join(cwd, "trace.txt"))
+        self.assertEqual("no trace for this CI job", client.get("/traces/job2").data.decode("utf-8"))
+        self.assertEqual("no trace available", client.get("/traces/job3").data.decode("utf-8"))
+
+    def test_restart(self):
+        """ the traces of a previous run are still served """
+        traces_dir = tempfile.mkdtemp()
+        server = gakoci.GakoCI(repos=["monperrus/test"], traces_dir=traces_dir)
+        cwd = tempfile.mkdtemp()
+        with open(os.path.join(cwd, "trace.txt"), "w") as f: f.write("foo\n")
+        server.traces.ingest("job1", os.path.join(cwd, "trace.txt"))
+        server = gakoci.GakoCI(repos=["monperrus/test"], traces_dir=traces_dir)
+        self.assertEqual("foo\n", server.application.test_client().get("/traces/job1").data.decode("utf-8"))
+        self.assertEqual(["job1"], list(server.traces.sizes.keys()))
+        self.assertEqual(os.path.getsize(server.traces.get_path("job1")), server.traces.total)
+
+    def test_retention(self):
+        store = gakoci.TraceStore(tempfile.mkdtemp(), max_bytes=2500)
+        for i in range(5):
+            cwd = tempfile.mkdtemp()
+            with open(os.path.join(cwd, "trace.txt"), "wb") as f: f.write(os.urandom(1000))
+            store.ingest("job" + str(i), os.path.join(cwd, "trace.txt"))
+            # distinct modification times
+            os.utime(store.get_path("job" + str(i)), (i, i))
+        store.apply_retention()
+        self.assertEqual([False, False, False, True, True], [store.has("job" + str(i)) for i in range(5)])
+
+
+class TraceIndexTestCase(unittest.TestCase):
+    """  python3 -m unittest test.TraceIndexTestCase  """
+
+    def setUp(self):
+        try:
+            gakoci.TraceIndex(":memory:", None)
+        except sqlite3.OperationalError:
+            self.skipTest("SQLite without FTS5")
+
+    def add(self, server, job_id, repo, finished, content):
+        cwd = tempfile.mkdtemp()
+        with open(os.path.join(cwd, "trace.txt"), "w") as f: f.write(content)
+        server.ran[job_id] = cwd
+        server.trace_index.add(job_id, {'repo': repo, 'task': 'push-foo', 'finished': finished}, os.path.join(cwd, "trace.txt"))
+        server.traces.ingest(job_id, os.path.join(cwd, "trace.txt"))
+
+    def test_search(self):
+        server = gakoci.GakoCI(repos=["monperrus/test"], traces_dir=tempfile.mkdtemp())
+        self.add(server, "job1", "monperrus/test", 1000, "compiling\nTests run: 3, Failures: 1\nat Foo.java:12 NullPointerException\n")
+        self.add(server, "job2", "monperrus/test", 2000, "compiling\nTests run: 3, Failures: 0\n")
+        self.add(server, "job3", "monperrus/other", 3000, "NullPointerException\n")
+
+        result = server.trace_index.search("NullPointerException")
+        # most recent first
+        self.assertEqual(["job3", "job1"], [x['job_id'] for x in result])
+        self.assertEqual([{'line_number': 3, 'text': 'at Foo.java:12 NullPointerException'}], result[1]['lines'])
+        self.assertEqual(["job1"], [x['job_id'] for x in server.trace_index.search("Foo.java:12")])
+        self.assertEqual(["job1"], [x['job_id'] for x in server.trace_index.search("NullPointerException", repo="monperrus/test")])
+        self.assertEqual(["job2"], [x['job_id'] for x in server.trace_index.search("compiling", since=1500)])
+
+        # all the words, on different lines of the trace
+        result = server.trace_index.search("NullPointerException Failures")
+        self.assertEqual(["job1"], [x['job_id'] for x in result])
+        self.assertEqual([2, 3], [x['line_number'] for x in result[0]['lines']])
+
+        server.trace_index.remove(["job1"])
+        self.assertEqual(["job3"], [x['job_id'] for x in server.trace_index.search("NullPointerException")])
+        self.assertEqual([], server.trace_index.search("NullPointerException Failures"))
+        # words without token characters are ignored
+        self.assertEqual(["job3"], [x['job_id'] for x in server.trace_index.search("NullPointerException -")])
+        # the other traces are still there
+        self.assertEqual(["job2"], [x['job_id'] for x in server.trace_index.search("compiling")])
+
+        client = server.application.test_client()
+        response = client.get("/traces/search?q=Failures&repo=monperrus/test&since=1970-01-01T00:25:00")
+        result = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(["job2"], [x['job_id'] for x in result])
+        self.assertTrue(result[0]['trace_url'].endswith("/traces/job2"))
+        self.assertEqual(400, client.get("/traces/search").status_code)
+        self.assertEqual(400, client.get("/traces/search?q=foo&since=yesterday").status_code)
+        self.assertEqual(86400, gakoci.parse_since("1970-01-02"))
+
+    def test_index_failure(self):
+        """ a failure of the index does not lose the result of the job """
+        if os.path.exists("testhooks"):
+            shutil.rmtree("testhooks")
+        os.system('mkdir -p testhooks')
+        os.system('printf "#!/bin/sh\necho foo | tee trace.txt"  > testhooks/push-monperrus-test')
+        os.system('chmod 755 testhooks/*')
+        server = gakoci.GakoCI(repos=["monperrus/test"], hooks_dir="testhooks", traces_dir=tempfile.mkdtemp())
+        def locked(job_id, job, trace_path): raise sqlite3.OperationalError("database is locked")
+        server.trace_index.add = locked
+        event_action = server.get_core_info_depending_on_event_type("push", 'test/resources/push_event.json')
+        server.execute_task(gakoci.ScriptCITask("testhooks/push-monperrus-test"), event_action)
+        job_id = list(server.jobs.keys())[0]
+        self.assertEqual(0, server.jobs[job_id]['returncode'])
+        self.assertTrue(server.jobs[job_id]['finished'] >= server.jobs[job_id]['start'])
+        self.assertTrue(server.traces.has(job_id))
+        shutil.rmtree("testhooks")
+
+    def test_retention(self):
+        """ the index counts in the disk space of the traces """
+        server = gakoci.GakoCI(repos=["monperrus/test"], traces_dir=tempfile.mkdtemp())
+        server.traces.max_bytes = server.trace_index.size() + 40000
+        for i in range(10):
+            self.add(server, "job" + str(i), "monperrus/test", i, "".join("line " + str(j) + " job" + str(i) + "\n" for j in range(1000)))
+        self.assertTrue(server.trace_index.size() + sum(os.path.getsize(server.traces.get_path("job" + str(i))) for i in range(10) if server.traces.has("job" + str(i))) <= server.traces.max_bytes)
+        self.assertTrue(server.traces.has("job9"))
+        self.assertFalse(server.traces.has("job0"))
+        # the removed traces are not in the index anymore
+        self.assertEqual([], server.trace_index.search("job0"))
+        self.assertEqual(["job9"], [x['job_id'] for x in server.trace_index.search("job9")])
+
+
 class CoreTestCase(unittest.TestCase):
     """ test the server using Ngrok (works on localhost and travis) """
     """ python3 -m unittest test.CoreTestCase """